@@ -2,21 +2,30 @@
 # Inspired by
 # https://stackoverflow.com/questions/28436473/build-gradle-repository-for-offline-development
 
+import argparse
+import http.client
+import json
 import os
 import glob
 import shutil
 import subprocess
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import total_ordering
-from urllib import request, error as urlerror
+from urllib.parse import urljoin, urlsplit
 from hashlib import sha1
 
 APP_ID = "org.audiveris.audiveris"
+MAVEN_CENTRAL = "https://repo1.maven.org/maven2"
 project_dir = os.path.dirname(os.path.realpath(__file__))
 
 @total_ordering
 class Artifact:
 
+    # Can be overridden, e.g. to test against a local Maven Central stand-in
+    maven_central = MAVEN_CENTRAL
+
     def __init__(self, group_id, artifact_id, version_id, item_name, sha1):
         self.group_id = group_id.replace(".", "/")
         self.artifact_id = artifact_id
@@ -31,14 +40,24 @@ class Artifact:
     def path(self):
         return "/".join([self.dir(), self.item_name])
 
-    def url(self):
+    def key(self):
+        # Repository and artifact coordinates, used as key in the sha1 cache.
+        # The repository is part of the key, so that sums fetched from a
+        # stand-in repository never end up in a real dependencies.yml
+        return " ".join([self.repository(),
+                         ":".join([self.group_id.replace("/", "."), self.artifact_id,
+                                   self.version_id, self.item_name])])
+
+    def repository(self):
         if self.artifact_id.startswith("com.springsource.javax.media.jai"):
-            host = "https://repository.springsource.com/maven/bundles/external"
+            return "https://repository.springsource.com/maven/bundles/external"
         elif self.artifact_id in ("jai-core", "jai-codec"):
-            host = "https://repository.jboss.org/nexus/content/repositories/thirdparty-releases"
+            return "https://repository.jboss.org/nexus/content/repositories/thirdparty-releases"
         else:
-            host = "https://repo1.maven.org/maven2"
-        return "/".join([host, self.path()])
+            return self.maven_central
+
+    def url(self):
+        return "/".join([self.repository(), self.path()])
 
     def yml(self, indent=6):
         spc = indent * " "
@@ -65,23 +84,142 @@ ln -f {self.item_name} {"/".join([dir, self.item_name])}
         return (self.path(), self.sha1) < (other.path(), other.sha1)
 
 
-def main(build_dir):
-    artifacts = []
-    repo_dir = os.path.join(project_dir, "dependencies")
-    temp_home = os.path.join(build_dir, "dev/flatpak/gradle")
-    if not os.path.isdir(build_dir):
-        raise RuntimeError(f"{build_dir} does not exist")
+class Sha1Cache:
+    """On-disk cache of sha1 sums, keyed by artifact coordinates."""
 
-    os.chdir(build_dir)
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if path and os.path.isfile(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, sha1):
+        self.entries[key] = sha1
+
+    def save(self):
+        if self.path:
+            with open(self.path, "w") as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+                f.write("\n")
+
+
+class Sha1Fetcher:
+    """Fetches small files over HTTP(S), keeping one connection per host and thread alive."""
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def _connection(self, scheme, netloc):
+        conns = getattr(self.local, "conns", None)
+        if conns is None:
+            conns = self.local.conns = {}
+        conn = conns.get((scheme, netloc))
+        if conn is None:
+            cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            conn = cls(netloc, timeout=self.timeout)
+            conns[(scheme, netloc)] = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def fetch(self, url, max_redirects=5):
+        for _ in range(max_redirects + 1):
+            status, reason, location, body = self._get(url)
+            if status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                continue
+            if status != 200:
+                raise RuntimeError(f"HTTP {status} {reason}")
+            return body
+        raise RuntimeError(f"too many redirects, last one to {url}")
+
+    def _get(self, url):
+        parts = urlsplit(url)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        # Retry once, the server may have closed an idle keep-alive connection
+        for attempt in range(2):
+            conn = self._connection(parts.scheme, parts.netloc)
+            try:
+                conn.request("GET", path, headers={"Connection": "keep-alive"})
+                response = conn.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                del self.local.conns[(parts.scheme, parts.netloc)]
+                if attempt:
+                    raise
+            else:
+                return response.status, response.reason, response.getheader("Location"), body
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+
+
+def arm64_artifact(artifact):
+    return Artifact(artifact.group_id.replace("/", "."), artifact.artifact_id,
+                    artifact.version_id,
+                    artifact.item_name.replace("-linux-x86_64.jar", "-linux-arm64.jar"),
+                    "0")
 
-    # By default, gradle stores the cached artifacts under $HOME/.gradle
-    # We can't uset that because it might contain lots of artifacts that
-    # we don't need. Therefore use a different user home (-g)
-    # Fixme: how to clean up this temp dir?
-    # Fixme: do we need to call the "build" task, really?
-    subprocess.call(["./gradlew", "-q", "-g", temp_home, "build"])
-    os.chdir(project_dir)
 
+def resolve_sha1s(artifacts, cache, offline=False, jobs=8):
+    """Returns the artifacts with their sha1 set, skipping those that can't be resolved."""
+    resolved = []
+    missing = []
+    for artifact in artifacts:
+        sha1 = cache.get(artifact.key())
+        if sha1:
+            artifact.sha1 = sha1
+            resolved.append(artifact)
+        elif offline:
+            print(f"ERROR: no cached sha1 for {artifact.key()} (offline)")
+        else:
+            missing.append(artifact)
+
+    if not missing:
+        return resolved
+
+    fetcher = Sha1Fetcher()
+
+    def lookup(artifact):
+        url = artifact.url() + ".sha1"
+        try:
+            return url, fetcher.fetch(url).strip()
+        except Exception:
+            print(f"ERROR opening '{url}': {sys.exc_info()[1]}")
+            return url, None
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(lookup, missing))
+    finally:
+        fetcher.close()
+
+    for artifact, (url, sha1) in zip(missing, results):
+        if sha1 is None:
+            continue
+        if len(sha1) == 40:
+            artifact.sha1 = sha1.decode("utf-8")
+            cache.put(artifact.key(), artifact.sha1)
+            resolved.append(artifact)
+            print(f"Added sha1 for {url}: {artifact.sha1}")
+        else:
+            print(f"ERROR: invalid sha1 for {url}: {sha1.decode('utf-8')}")
+    return resolved
+
+
+def collect_artifacts(gradle_home):
+    artifacts = []
     # Dir layout of file created by gradle: e.g.
     # ${GRADLE_TEMP}/caches/modules-2/files-2.1/org.audiveris/proxymusic/4.0.2/7a747a5b8d1e738e74abf883d9c23b0b18f0bf22/proxymusic-4.0.2.jar
 
@@ -89,19 +227,15 @@ def main(build_dir):
     # dependencies/org/audiveris/proxymusic/4.0.2
 
     # cache_files = ${GRADLE_TEMP}/caches/modules-*/files-*/
-    cache_files = os.path.join(temp_home, "caches", "modules-*", "files-*")
+    cache_files = os.path.join(gradle_home, "caches", "modules-*", "files-*")
     for cache_dir in glob.glob(cache_files):
         # cache_dir = ${GRADLE_TEMP}/caches/modules-2/files-2.1/
         for cache_group_id in os.listdir(cache_dir):
             # cache group_id is the "vendor", e.g. "org.audiveris"
             cache_group_dir = os.path.join(cache_dir, cache_group_id)
-            # repo_group_dir changes this to maven format
-            # repo_group_dir = "dependencies/org/audiveris"
-            repo_group_dir = os.path.join(repo_dir, cache_group_id.replace('.', '/'))
             for cache_artifact_id in os.listdir(cache_group_dir):
                 # cache_artifact_id = "proxymusic"
                 cache_artifact_dir = os.path.join(cache_group_dir, cache_artifact_id)
-                repo_artifact_dir = os.path.join(repo_group_dir, cache_artifact_id)
                 for cache_version_id in os.listdir(cache_artifact_dir):
                     # cache_version_id = "4.0.2"
                     cache_version_dir = os.path.join(cache_artifact_dir, cache_version_id)
@@ -115,23 +249,40 @@ def main(build_dir):
                                             cache_version_id, cache_item_name,
                                             os.path.basename(os.path.dirname(cache_item)))
                         artifacts.append(artifact)
-                        if cache_item_name.endswith("-linux-x86_64.jar"):
-                            url = artifact.url().replace("-linux-x86_64.jar", "-linux-arm64.jar.sha1")
-                            try:
-                                conn = request.urlopen(url)
-                                sha1 = conn.read()
-                            except urlerror.HTTPError:
-                                print(f"ERROR opening '{url}': {sys.exc_info()[1]}")
-                            else:
-                                if len(sha1) == 40:
-                                    arm = Artifact(cache_group_id, cache_artifact_id,
-                                                   cache_version_id,
-                                                   cache_item_name.replace("-linux-x86_64.jar", "-linux-arm64.jar"),
-                                                   sha1.decode("utf-8"))
-                                    artifacts.append(arm)
-                                    print(f"Added sha1 for {url}: {sha1.decode('utf-8')}")
-                                else:
-                                    print(f"ERROR: invalid sha1 for {url}: {sha1.decode('utf-8')}")
+    return artifacts
+
+
+def main(build_dir, gradle_home=None, build=True, cache_file=None,
+         offline=False, jobs=8):
+    if gradle_home is None:
+        gradle_home = os.path.join(build_dir, "dev/flatpak/gradle")
+    if not os.path.isdir(build_dir):
+        raise RuntimeError(f"{build_dir} does not exist")
+
+    if build:
+        os.chdir(build_dir)
+
+        # By default, gradle stores the cached artifacts under $HOME/.gradle
+        # We can't uset that because it might contain lots of artifacts that
+        # we don't need. Therefore use a different user home (-g)
+        # Fixme: how to clean up this temp dir?
+        # Fixme: do we need to call the "build" task, really?
+        subprocess.call(["./gradlew", "-q", "-g", gradle_home, "build"])
+    elif not os.path.isdir(gradle_home):
+        raise RuntimeError(f"{gradle_home} does not exist")
+    os.chdir(project_dir)
+
+    artifacts = collect_artifacts(gradle_home)
+
+    # Gradle on x86_64 only caches the x86_64 native jars, the sha1 of the
+    # arm64 variants must be looked up in the repository.
+    arm_artifacts = [arm64_artifact(a) for a in artifacts
+                     if a.item_name.endswith("-linux-x86_64.jar")]
+    cache = Sha1Cache(cache_file)
+    resolved = resolve_sha1s(arm_artifacts, cache, offline=offline, jobs=jobs)
+    cache.save()
+    unresolved = [a for a in arm_artifacts if all(a is not r for r in resolved)]
+    artifacts += resolved
 
     artifacts.sort()
 
@@ -145,6 +296,37 @@ def main(build_dir):
 {"".join([a.script() for a in artifacts])}
 """)
 
+    if unresolved:
+        print(f"ERROR: {len(unresolved)} arm64 artifact(s) missing, the generated files are incomplete:")
+        for artifact in unresolved:
+            print(f"  {artifact.key()}")
+    return unresolved
+
 if __name__ == "__main__":
     main_dir = os.path.dirname(os.path.dirname(project_dir))
-    main(main_dir)
+    parser = argparse.ArgumentParser(
+        description="Create the flatpak list of Java dependencies")
+    parser.add_argument("--gradle-home", metavar="DIR",
+                        help="gradle user home holding the artifact cache "
+                             "(default: dev/flatpak/gradle)")
+    parser.add_argument("--no-build", action="store_true",
+                        help="reuse the existing gradle cache instead of running ./gradlew build")
+    parser.add_argument("--sha1-cache", metavar="FILE",
+                        default=os.path.join(project_dir, "sha1-cache.json"),
+                        help="on-disk cache of looked up sha1 sums (default: %(default)s)")
+    parser.add_argument("--offline", action="store_true",
+                        help="don't access the network: reuse the gradle cache "
+                             "(implies --no-build) and use only the sha1 cache")
+    parser.add_argument("-j", "--jobs", type=int, default=8,
+                        help="number of concurrent sha1 lookups (default: %(default)s)")
+    parser.add_argument("--maven-url", default=MAVEN_CENTRAL,
+                        help="Maven Central base URL (default: %(default)s)")
+    args = parser.parse_args()
+
+    Artifact.maven_central = args.maven_url.rstrip("/")
+    gradle_home = os.path.abspath(args.gradle_home) if args.gradle_home else None
+    unresolved = main(main_dir, gradle_home=gradle_home,
+                      build=not (args.no_build or args.offline),
+                      cache_file=os.path.abspath(args.sha1_cache),
+                      offline=args.offline, jobs=max(1, args.jobs))
+    sys.exit(1 if unresolved else 0)
@@ -9,6 +9,8 @@ from supabase import create_client, Client
 import cv2
 import pytesseract
 import re
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 import PyPDF2
 from pdf2image import convert_from_path
 import numpy as np
@@ -33,14 +35,24 @@ PREDICTION_KEY = "766d399db6b3416388ea24beb1e8da70"
 PROJECT_ID = "3eff9248-d5db-4744-a439-a7c27050f639"
 PUBLISH_ITERATION_NAME = "Iteration4"  # Nome exato da iteração publicada
 
+# Configurações do OMR paralelo por páginas
+AUDIVERIS_PAGES_PER_JOB = int(os.getenv("AUDIVERIS_PAGES_PER_JOB", "4"))
+AUDIVERIS_CPU_BUDGET = int(os.getenv("AUDIVERIS_CPU_BUDGET", str(os.cpu_count() or 1)))
+AUDIVERIS_CPUS_PER_JOB = int(os.getenv("AUDIVERIS_CPUS_PER_JOB", "2"))
+# Diferença mínima (em décimos) de margem esquerda para considerar o sistema indentado
+INDENT_TOLERANCE = 20.0
 
-def run_audiveris_docker(input_path, output_dir):
+
+def run_audiveris_docker(input_path, output_dir, cpus=None):
     input_dir = os.path.dirname(input_path)
     file_name = os.path.basename(input_path)
     # Corrige o caminho para Windows (barra invertida para barra normal)
     input_dir_docker = input_dir.replace('\\', '/')
-    docker_cmd = [
-        "docker", "run", "--rm",
+    docker_cmd = ["docker", "run", "--rm"]
+    # Limita os núcleos do container quando corre em paralelo com outros
+    if cpus:
+        docker_cmd += ["--cpus", str(cpus)]
+    docker_cmd += [
         "-v", f"{input_dir_docker}:/data",
         "lsouchet/audiveris",
         "-batch", f"/data/{file_name}",
@@ -50,6 +62,165 @@ def run_audiveris_docker(input_path, output_dir):
     if result.returncode != 0:
         raise RuntimeError(f"Erro ao rodar Audiveris via Docker: {result.stderr}")
 
+def find_musicxml_files(output_dir):
+    # Audiveris exporta um ficheiro por movimento (ex: nome.mvt1.xml, nome.mvt2.xml)
+    def movement_order(path):
+        match = re.search(r'\.mvt(\d+)\.xml$', path, re.IGNORECASE)
+        return (int(match.group(1)) if match else 0, path)
+
+    xml_files = []
+    for root, _, files in os.walk(output_dir):
+        for fname in files:
+            if fname.lower().endswith(".xml"):
+                xml_files.append(os.path.join(root, fname))
+    return sorted(xml_files, key=movement_order)
+
+def count_pdf_pages(pdf_path):
+    try:
+        return len(PyPDF2.PdfReader(pdf_path).pages)
+    except Exception:
+        return 0
+
+def split_pdf_into_ranges(pdf_path, work_dir, pages_per_job):
+    # Cada intervalo de páginas fica numa pasta própria, pois o container
+    # monta a pasta do ficheiro de entrada e escreve em <pasta>/output
+    reader = PyPDF2.PdfReader(pdf_path)
+    file_name = os.path.basename(pdf_path)
+    total_pages = len(reader.pages)
+    chunks = []
+    for start in range(0, total_pages, pages_per_job):
+        end = min(start + pages_per_job, total_pages)
+        chunk_dir = os.path.join(work_dir, f"pages_{start + 1:04d}-{end:04d}")
+        os.makedirs(chunk_dir, exist_ok=True)
+        writer = PyPDF2.PdfWriter()
+        for page in reader.pages[start:end]:
+            writer.add_page(page)
+        chunk_path = os.path.join(chunk_dir, file_name)
+        with open(chunk_path, "wb") as f:
+            writer.write(f)
+        chunks.append(chunk_path)
+    return chunks
+
+def _part_ids(root):
+    return [part.get("id") for part in root.iter("score-part")]
+
+def _system_left_margins(root):
+    # Margens esquerdas dos sistemas do primeiro instrumento, pela ordem do documento
+    part = root.find("part")
+    if part is None:
+        return []
+    margins = []
+    for measure in part.findall("measure"):
+        margin = measure.find("print/system-layout/system-margins/left-margin")
+        if margin is not None and margin.text:
+            try:
+                margins.append(float(margin.text))
+            except ValueError:
+                pass
+    return margins
+
+def _continues_movement(previous, current):
+    # Uma secção continua o movimento anterior se tiver os mesmos instrumentos
+    # e o primeiro sistema não estiver indentado (o Audiveris usa a indentação
+    # para detetar o início de um novo movimento)
+    if _part_ids(previous) != _part_ids(current):
+        return False
+    previous_margins = _system_left_margins(previous)
+    current_margins = _system_left_margins(current)
+    if previous_margins and current_margins:
+        return current_margins[0] <= previous_margins[-1] + INDENT_TOLERANCE
+    return True
+
+# Prefixo que o Audiveris dá à segunda metade de um compasso dividido por uma repetição
+SECOND_HALF_PREFIX = "X"
+
+def _last_measure_number(part):
+    # Último número de compasso numérico (ignora as segundas metades "X")
+    for measure in reversed(part.findall("measure")):
+        try:
+            return int(measure.get("number", ""))
+        except ValueError:
+            continue
+    return 0
+
+def _shift_measure_number(number, offset):
+    prefix = ""
+    if number.startswith(SECOND_HALF_PREFIX):
+        prefix, number = SECOND_HALF_PREFIX, number[len(SECOND_HALF_PREFIX):]
+    try:
+        return f"{prefix}{int(number) + offset}"
+    except ValueError:
+        return prefix + number
+
+def _append_measures(target, source):
+    for target_part, source_part in zip(target.findall("part"), source.findall("part")):
+        measures = source_part.findall("measure")
+        if not measures:
+            continue
+        # Continua a numeração do movimento anterior, mantendo a do Audiveris
+        offset = _last_measure_number(target_part)
+        for measure in measures:
+            if measure.get("number") is not None:
+                measure.set("number", _shift_measure_number(measure.get("number"), offset))
+        # Marca a quebra de página entre os intervalos recombinados
+        print_el = measures[0].find("print")
+        if print_el is None:
+            print_el = ET.Element("print")
+            measures[0].insert(0, print_el)
+        print_el.set("new-page", "yes")
+        target_part.extend(measures)
+
+def merge_musicxml_pages(page_results, output_dir, base_name):
+    # page_results: lista (pela ordem das páginas) das listas de MusicXML de cada intervalo
+    movements = []
+    for xml_files in page_results:
+        for index, xml_path in enumerate(xml_files):
+            root = ET.parse(xml_path).getroot()
+            if index == 0 and movements and _continues_movement(movements[-1], root):
+                _append_measures(movements[-1], root)
+            else:
+                movements.append(root)
+
+    os.makedirs(output_dir, exist_ok=True)
+    merged_paths = []
+    for number, root in enumerate(movements, start=1):
+        if len(movements) == 1:
+            fname = f"{base_name}.xml"
+        else:
+            fname = f"{base_name}.mvt{number}.xml"
+        merged_path = os.path.join(output_dir, fname)
+        ET.ElementTree(root).write(merged_path, encoding="UTF-8", xml_declaration=True)
+        merged_paths.append(merged_path)
+    return merged_paths
+
+def run_audiveris_parallel(input_path, output_dir, pages_per_job, workers, cpus_per_job):
+    work_dir = os.path.join(os.path.dirname(input_path), "pages")
+    chunks = split_pdf_into_ranges(input_path, work_dir, pages_per_job)
+
+    def recognize(chunk_path):
+        chunk_output = os.path.join(os.path.dirname(chunk_path), "output")
+        os.makedirs(chunk_output, exist_ok=True)
+        run_audiveris_docker(chunk_path, chunk_output, cpus=cpus_per_job)
+        return find_musicxml_files(chunk_output)
+
+    # map preserva a ordem das páginas, independentemente da ordem de conclusão
+    with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+        page_results = list(executor.map(recognize, chunks))
+
+    base_name = os.path.splitext(os.path.basename(input_path))[0]
+    return merge_musicxml_pages(page_results, output_dir, base_name)
+
+def run_omr(input_path, output_dir):
+    # Devolve os MusicXML de todos os movimentos reconhecidos, pela ordem da partitura
+    workers = max(1, AUDIVERIS_CPU_BUDGET // max(1, AUDIVERIS_CPUS_PER_JOB))
+    pages_per_job = max(1, AUDIVERIS_PAGES_PER_JOB)
+    if input_path.lower().endswith(".pdf") and workers > 1:
+        if count_pdf_pages(input_path) > pages_per_job:
+            return run_audiveris_parallel(input_path, output_dir, pages_per_job,
+                                          workers, AUDIVERIS_CPUS_PER_JOB)
+    run_audiveris_docker(input_path, output_dir)
+    return find_musicxml_files(output_dir)
+
 def convert_musicxml_to_midi(musicxml_path, midi_path):
     score = music21.converter.parse(musicxml_path)
     score.write("midi", fp=midi_path)
@@ -132,19 +303,11 @@ def validate_sheet(file: UploadFile = File(...)):
 
         # Executa o Audiveris via Docker
         try:
-            run_audiveris_docker(input_path, output_dir)
+            musicxml_paths = run_omr(input_path, output_dir)
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Erro ao executar Audiveris via Docker: {str(e)}")
 
-        # Procura arquivos MusicXML no output
-        found_xml = False
-        for root, _, files in os.walk(output_dir):
-            for fname in files:
-                if fname.lower().endswith(".xml"):
-                    found_xml = True
-                    break
-
-        if found_xml:
+        if musicxml_paths:
             return JSONResponse({"valid": True, "message": "Partitura reconhecida com sucesso."})
         else:
             return JSONResponse({"valid": False, "message": "Não foi possível reconhecer uma partitura no arquivo enviado."})
@@ -160,46 +323,48 @@ def validate_and_convert(file: UploadFile = File(...)):
         os.makedirs(output_dir, exist_ok=True)
 
         try:
-            run_audiveris_docker(input_path, output_dir)
+            musicxml_paths = run_omr(input_path, output_dir)
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Erro ao executar Audiveris via Docker: {str(e)}")
 
-        # Procura o arquivo MusicXML
-        musicxml_path = None
-        for root, _, files in os.walk(output_dir):
-            for fname in files:
-                if fname.lower().endswith(".xml"):
-                    musicxml_path = os.path.join(root, fname)
-                    break
-
-        if not musicxml_path:
+        if not musicxml_paths:
             return JSONResponse({
                 "valid": False, 
                 "message": "Não foi possível reconhecer uma partitura no arquivo enviado."
             })
 
-        # Gera o arquivo MIDI
-        midi_path = os.path.join(output_dir, "output.mid")
+        # Gera um arquivo MIDI por movimento
+        midi_paths = []
+        for musicxml_path in musicxml_paths:
+            midi_path = os.path.splitext(musicxml_path)[0] + ".mid"
+            try:
+                convert_musicxml_to_midi(musicxml_path, midi_path)
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"Erro ao converter MusicXML para MIDI: {str(e)}")
+            midi_paths.append(midi_path)
+
+        movements = []
         try:
-            convert_musicxml_to_midi(musicxml_path, midi_path)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Erro ao converter MusicXML para MIDI: {str(e)}")
-
-        try:
-            # Upload do MusicXML
-            xml_url = upload_to_supabase(musicxml_path, "music-sheets-xml")
-            # Upload do MIDI
-            midi_url = upload_to_supabase(midi_path, "music-sheets-midi")
-            
-            # Extrai informações da partitura usando music21
-            score = music21.converter.parse(musicxml_path)
-            metadata = {
-                "title": score.metadata.title if score.metadata and score.metadata.title else "Sem título",
-                "composer": score.metadata.composer if score.metadata and score.metadata.composer else "Compositor desconhecido",
-                "key": str(score.analyze("key")),
-                "time_signature": str(score.getTimeSignatures()[0]) if score.getTimeSignatures() else "Desconhecido",
-                "measures": len(score.measureOffsets()),
-            }
+            for musicxml_path, midi_path in zip(musicxml_paths, midi_paths):
+                # Upload do MusicXML
+                xml_url = upload_to_supabase(musicxml_path, "music-sheets-xml")
+                # Upload do MIDI
+                midi_url = upload_to_supabase(midi_path, "music-sheets-midi")
+
+                # Extrai informações da partitura usando music21
+                score = music21.converter.parse(musicxml_path)
+                metadata = {
+                    "title": score.metadata.title if score.metadata and score.metadata.title else "Sem título",
+                    "composer": score.metadata.composer if score.metadata and score.metadata.composer else "Compositor desconhecido",
+                    "key": str(score.analyze("key")),
+                    "time_signature": str(score.getTimeSignatures()[0]) if score.getTimeSignatures() else "Desconhecido",
+                    "measures": len(score.measureOffsets()),
+                }
+                movements.append({
+                    "midi_url": midi_url,
+                    "xml_url": xml_url,
+                    "metadata": metadata
+                })
 
         except Exception as e:
             import traceback
@@ -210,12 +375,14 @@ def validate_and_convert(file: UploadFile = File(...)):
                 "traceback": tb
             })
 
+        # Os campos de topo referem-se ao primeiro movimento (compatibilidade)
         return JSONResponse({
             "valid": True,
             "message": "Partitura processada com sucesso.",
-            "midi_url": midi_url,
-            "xml_url": xml_url,
-            "metadata": metadata
+            "midi_url": movements[0]["midi_url"],
+            "xml_url": movements[0]["xml_url"],
+            "metadata": movements[0]["metadata"],
+            "movements": movements
         })
 
 @router.post("/validate-deep")